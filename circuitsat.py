@@ -1,82 +1,122 @@
-from copy import copy
-from enum import Enum
-from multiprocessing.sharedctypes import Value
-from queue import Empty
-from numpy import var
-
-from setuptools import find_packages
-import pycosat
+from itertools import chain
+import os
+import numpy as np
 
 
 def read_cnf_file(fname):
     try:
-        file = open(fname, 'r')
-        lines = file.readlines()
+        with open(fname, 'r') as file:
+            data = file.read()
 
-        for c, line in enumerate(lines):
-            if line[0] != 'c':
-                break
+        start = 0
+        while data.startswith('c', start):
+            start = data.find('\n', start) + 1
+            if start == 0:
+                raise ValueError
+        end = data.find('\n', start)
+        if end == -1:
+            end = len(data)
 
-        prob = lines[c].split()
+        prob = data[start:end].split()
         if len(prob) != 4 or prob[0] != 'p' or prob[1] != 'cnf':
             raise ValueError
         n = int(prob[2])
         m = int(prob[3])
 
-        lits = [int(val) for val in (("".join(lines[(c+1):])).split())]
+        body = data[end:]
+        tokens = len(body.split())
+        # fromstring reads a whitespace-only string as [0], older numpy
+        # stops at a malformed token instead of raising, and a lone '-' is
+        # joined to the next number, so every token must give one literal.
+        lits = np.empty(0, dtype=np.int64)
+        if tokens:
+            lits = np.fromstring(body, dtype=np.int64, sep=' ')
+        if len(lits) != tokens:
+            raise ValueError
+        if not ((lits >= -n) & (lits <= n)).all():
+            raise ValueError
 
-        clauses = []
-        clause = []
-        for lit in lits:
-            if lit == 0:
-                clauses.append(clause)
-                clause = []
-            elif lit < -n or lit > n:
-                raise ValueError
-            else:
-                clause.append(lit)
-        if len(clauses) != m:
+        ends = np.flatnonzero(lits == 0)
+        if len(ends) != m:
             raise ValueError
+        starts = np.r_[0, ends[:-1] + 1]
+
+        lits = lits.tolist()
+        clauses = [lits[start:end]
+                   for start, end in zip(starts.tolist(), ends.tolist())]
         return clauses
     except ValueError:
         return 'INVALID'
 
 
-def write_cnf_file(cnf, fname, comments=["no description"]):
-    file = open(fname, 'w')
-    for comment in comments:
-        file.write('c '+comment+'\n')
-    m = len(cnf)
-    lits = []
-    for c in cnf:
-        lits += c
-    n = max(max(lits), -min(lits))
-    file.write('p cnf {} {}\n'.format(n, m))
-    for c in cnf:
-        file.writelines((' '.join(map(str, c)))+' 0\n')
-    file.close()
+# Clause lines are encoded in blocks of about 64 KiB, and up to 16 blocks
+# (the smallest IOV_MAX POSIX allows) go to the kernel in one writev call.
+_WRITE_BLOCK_CLAUSES = 1 << 12
+_WRITEV_BLOCKS = 16
 
 
-gate_types = "01CANOEX"
-nullary_gates = "01"
-unary_gates = "CN"
-binary_gates = "AOEX"
+def write_buffers(fd, buffers):
+    # Both os.writev and os.write may write fewer bytes than asked for.
+    if not hasattr(os, 'writev'):
+        buffers = [b''.join(buffers)]
+    while buffers:
+        if len(buffers) == 1:
+            written = os.write(fd, buffers[0])
+        else:
+            written = os.writev(fd, buffers)
+        for i, buffer in enumerate(buffers):
+            if written < len(buffer):
+                buffers = [buffer[written:]] + buffers[i+1:]
+                break
+            written -= len(buffer)
+        else:
+            buffers = []
+
+
+def write_cnf_stream(clauses, n, m, fname, comments=["no description"]):
+    header = ''.join('c '+comment+'\n' for comment in comments)
+    header += 'p cnf {} {}\n'.format(n, m)
+
+    with open(fname, 'wb', buffering=0) as file:
+        fd = file.fileno()
+        buffers = [header.encode()]
+        lines = []
+        for c in clauses:
+            lines.append(' '.join(map(str, c)) + ' 0\n')
+            if len(lines) == _WRITE_BLOCK_CLAUSES:
+                buffers.append(''.join(lines).encode())
+                lines = []
+                if len(buffers) == _WRITEV_BLOCKS:
+                    write_buffers(fd, buffers)
+                    buffers = []
+        buffers.append(''.join(lines).encode())
+        write_buffers(fd, buffers)
+
 
+def write_cnf_file(cnf, fname, comments=["no description"]):
+    n = max((abs(lit) for c in cnf for lit in c), default=0)
+    write_cnf_stream(cnf, n, len(cnf), fname, comments)
+
+
+_GATE_ARITY = {'0': 0, '1': 0, 'C': 1, 'N': 1, 'A': 2, 'O': 2, 'E': 2, 'X': 2}
+# Parsed gates are stored as (type_id, h1, h2) with 0 for missing inputs.
+_GATE_TYPES = '01CNAOEX'
+_GATE_TYPE_IDS = {t: i for i, t in enumerate(_GATE_TYPES)}
+_TYPE_ARITY = tuple(_GATE_ARITY[t] for t in _GATE_TYPES)
 
-def valid_gate_type(g):
-    return len(g) == 1 and gate_types.find(g) != -1
+valid_gate_type = _GATE_ARITY.__contains__
 
 
 def is_nullary(g):
-    return len(g) == 1 and nullary_gates.find(g) != -1
+    return _GATE_ARITY.get(g) == 0
 
 
 def is_unary(g):
-    return len(g) == 1 and unary_gates.find(g) != -1
+    return _GATE_ARITY.get(g) == 1
 
 
 def is_binary(g):
-    return len(g) == 1 and binary_gates.find(g) != -1
+    return _GATE_ARITY.get(g) == 2
 
 
 def is_gate_valid(h, g):
@@ -88,18 +128,18 @@ class Circuit:
         self.gates = gates
 
     def __str__(self):
-        tmp = []
-        for i, gate in enumerate(self.gates, self.n+1):
-            tmp.append('{} : {}\n'.format(i, gate))
-        return ''.join(tmp)
+        # Shows each gate as in the file: its letter and only the inputs its
+        # arity uses, e.g. ['N', 1].
+        return ''.join(f'{i} : {[_GATE_TYPES[t], *(h1, h2)[:_TYPE_ARITY[t]]]}\n'
+                       for i, (t, h1, h2) in enumerate(self.gates, self.n+1))
 
 
 def read_circuit_file(fname):
     gates = []
 
     try:
-        file = open(fname)
-        lines = [line[:-1] for line in file.readlines()]
+        with open(fname) as file:
+            lines = file.read().splitlines()
 
         if len(lines) < 2 or not lines:
             raise ValueError
@@ -111,26 +151,25 @@ def read_circuit_file(fname):
             line_length = len(line)
             g = line[0]
 
-            if not(valid_gate_type(g)):
+            arity = _GATE_ARITY.get(g)
+
+            if arity is None or line_length != arity + 1:
                 raise ValueError
 
-            if is_nullary(g) and line_length == 1:
-                if line_length != 1:
-                    raise ValueError
-                gates += [[g]]
-            elif is_unary(g) and line_length == 2:
+            t = _GATE_TYPE_IDS[g]
+            if arity == 0:
+                gates.append((t, 0, 0))
+            elif arity == 1:
                 h1 = int(line[1])
                 if not(is_gate_valid(h1, g_number_so_far)):
                     raise ValueError
-                gates += [[g, h1]]
-            elif is_binary(g) and line_length == 3:
+                gates.append((t, h1, 0))
+            else:
                 h1 = int(line[1])
                 h2 = int(line[2])
                 if not(is_gate_valid(h1, g_number_so_far)) or not(is_gate_valid(h2, g_number_so_far)):
                     raise ValueError
-                gates += [[g, h1, h2]]
-            else:
-                raise ValueError
+                gates.append((t, h1, h2))
 
             g_number_so_far += 1
 
@@ -139,101 +178,123 @@ def read_circuit_file(fname):
         return "INVALID"
 
 
-def CSAT_to_SAT(circuit):
-    cnf = []
-
-    for g, gate in enumerate(circuit.gates, start=circuit.n + 1):
-        gate_type = gate[0]
-        gate_length = len(gate)
-
-        h1 = 0
-        h2 = 0
-
-        if gate_length == 2:
-            h1 = gate[1]
-        elif gate_length == 3:
-            h1 = gate[1]
-            h2 = gate[2]
-
-        if gate_type == "0":
-            cnf += [[-g]]
-        elif gate_type == "1":
-            cnf += [[g]]
-        elif gate_type == "C":
-            cnf += [[g, -h1], [-g, h1]]
-        elif gate_type == "N":
-            cnf += [[g, h1], [-g, -h1]]
-        elif gate_type == "A":
-            cnf += [[-g, h1], [-g, h2], [g, -h1, -h2]]
-        elif gate_type == "O":
-            cnf += [[g, -h1], [g, -h2], [-g, h1, h2]]
-        elif gate_type == "E":
-            cnf += [[g, -h1, -h2], [g, h1, h2], [-g, h1, -h2], [-g, -h1, h2]]
-        else:
-            cnf += [[-g, -h1, -h2], [-g, h1, h2], [g, h1, -h2], [g, -h1, h2]]
+# Indexed by gate type id, see _GATE_TYPES.
+_CLAUSE_TEMPLATES = [
+    lambda g, h1, h2: ((-g,),),
+    lambda g, h1, h2: ((g,),),
+    lambda g, h1, h2: ((g, -h1), (-g, h1)),
+    lambda g, h1, h2: ((g, h1), (-g, -h1)),
+    lambda g, h1, h2: ((-g, h1), (-g, h2), (g, -h1, -h2)),
+    lambda g, h1, h2: ((g, -h1), (g, -h2), (-g, h1, h2)),
+    lambda g, h1, h2: ((g, -h1, -h2), (g, h1, h2), (-g, h1, -h2), (-g, -h1, h2)),
+    lambda g, h1, h2: ((-g, -h1, -h2), (-g, h1, h2), (g, h1, -h2), (g, -h1, h2)),
+]
+_CLAUSE_COUNTS = [len(template(1, 2, 3)) for template in _CLAUSE_TEMPLATES]
+
+
+def unique_clauses(clauses):
+    seen = set()
+    unique = []
+    for clause in clauses:
+        key = tuple(sorted(clause))
+        if key not in seen:
+            seen.add(key)
+            unique.append(clause)
+    return unique
+
+
+def iter_CSAT_clauses(circuit, verbose=False):
+    deduplicated = 0
+    clauses = ()
+
+    # Every clause mentions its own gate variable, so duplicates can only
+    # appear within one gate, i.e. a binary gate with both inputs equal.
+    for g, (t, h1, h2) in enumerate(circuit.gates, start=circuit.n + 1):
+        clauses = _CLAUSE_TEMPLATES[t](g, h1, h2)
+        if h1 == h2 and _TYPE_ARITY[t] == 2:
+            unique = unique_clauses(clauses)
+            deduplicated += len(clauses) - len(unique)
+            clauses = unique
+        yield from clauses
+
+    output = (circuit.n + len(circuit.gates),)
+    if clauses and clauses[-1] == output:
+        deduplicated += 1
+    else:
+        yield output
 
-    cnf += [[circuit.n + len(circuit.gates)]]
-    return cnf
+    if verbose:
+        print('removed {} duplicate clauses'.format(deduplicated))
 
 
-def create_distinct_variables_cnf(n, g):
-    cnf = []
-    var_list = [e+1 for e in range(n)]
-    original_vars = var_list[:int(len(var_list)/2)]
-    copy_vars = var_list[int(len(var_list)/2):]
-    tuple_list = list(zip(original_vars, copy_vars))
-    t1, t2 = tuple_list[0]
-    cnf += [[-g, -t1, -t2], [-g, t1, t2], [g, t1, -t2], [g, -t1, t2]]
-    g += 1
+def count_CSAT_clauses(circuit):
+    # Matches what iter_CSAT_clauses emits: a binary gate with equal inputs
+    # loses one duplicate clause, and a trailing '1' gate already asserts
+    # the output.
+    m = 1
+    for t, h1, h2 in circuit.gates:
+        m += _CLAUSE_COUNTS[t]
+        if h1 == h2 and _TYPE_ARITY[t] == 2:
+            m -= 1
+    if circuit.gates and circuit.gates[-1][0] == _GATE_TYPE_IDS['1']:
+        m -= 1
+    return m
 
-    for ti, tj in tuple_list[1:]:
-        cnf += [[-g, -ti, -tj], [-g, ti, tj], [g, ti, -tj], [g, -ti, tj]]
-        g += 1
-        cnf += [[g, -(g-2)], [g, -(g-1)], [-g, g-2, g-1]]
-        g += 1
-    return cnf
 
+def CSAT_to_SAT(circuit, verbose=False):
+    return list(iter_CSAT_clauses(circuit, verbose))
 
-def find_correct_copy_g(gate, n, original_g, circuit_len):
-    if gate <= n:
-        return n + gate
-    else:
-        return original_g + circuit_len
 
+def create_distinct_variables_cnf(n, g):
+    # Input i and its copy i + n/2 get an XOR gate, the XOR gates are ORed
+    # together in a chain, and the last gate of the chain is asserted.
+    half = n // 2
+    if half == 0:
+        # Without inputs no two assignments can differ.
+        yield from ((g,), (-g,))
+        return
+
+    yield from ((-g, -1, -(1+half)), (-g, 1, 1+half), (g, 1, -(1+half)), (g, -1, 1+half))
+    g += 1
 
-def find_correct_original_g(gate, n):
-    if gate > n:
-        return gate + n
-    return gate
+    for ti in range(2, half + 1):
+        tj = ti + half
+        yield from ((-g, -ti, -tj), (-g, ti, tj), (g, ti, -tj), (g, -ti, tj))
+        g += 1
+        yield from ((g, -(g-2)), (g, -(g-1)), (-g, g-2, g-1))
+        g += 1
+    yield (g - 1,)
 
 
 def copy_circuit(circuit):
     n = circuit.n
     double_n = 2 * n
-    original_gates = circuit.gates
+    gates_len = len(circuit.gates)
+    # In the composite circuit the copy's inputs follow the original inputs,
+    # so original gate h moves to h + n and its copy to h + n + gates_len.
+    copy_offset = n + gates_len
+    original_gates = []
     copy_gates = []
 
-    for index, gate in enumerate(circuit.gates):
-        gate_length = len(gate)
-
-        if gate_length == 1:
-            copy_gates += [[gate]]
-        elif gate_length == 2:
-            original_g = find_correct_original_g(gate[1], n)
-            original_gates[index] = [
-                gate[0], original_g]
-            copy_gates += [[gate[0],
-                            find_correct_copy_g(gate[1], n, original_g, len(original_gates))]]
+    for t, h1, h2 in circuit.gates:
+        arity = _TYPE_ARITY[t]
+
+        if arity == 0:
+            original_gates.append((t, 0, 0))
+            copy_gates.append((t, 0, 0))
+        elif arity == 1:
+            original_gates.append((t, h1 + n if h1 > n else h1, 0))
+            copy_gates.append((t, h1 + copy_offset if h1 > n else h1 + n, 0))
         else:
-            first_original_g = find_correct_original_g(gate[1], n)
-            second_original_g = find_correct_original_g(gate[2], n)
-            original_gates[index] = [
-                gate[0], first_original_g, second_original_g]
-            copy_gates += [[gate[0],
-                            find_correct_copy_g(gate[1], n, first_original_g, len(original_gates)), find_correct_copy_g(gate[2], n, second_original_g, len(original_gates))]]
-
-    last_gate = ["A", double_n + len(original_gates), double_n +
-                 len(original_gates) + len(copy_gates)]
+            original_gates.append((t,
+                                   h1 + n if h1 > n else h1,
+                                   h2 + n if h2 > n else h2))
+            copy_gates.append((t,
+                               h1 + copy_offset if h1 > n else h1 + n,
+                               h2 + copy_offset if h2 > n else h2 + n))
+
+    last_gate = (_GATE_TYPE_IDS['A'], double_n + gates_len,
+                 double_n + 2 * gates_len)
     return Circuit(double_n, original_gates + copy_gates + [last_gate])
 
 
@@ -242,8 +303,8 @@ def reduce_CSAT_to_SAT(infile, outfile):
     if circuit == "INVALID":
         write_cnf_file([[-1], [1]], outfile)
         return
-    cnf = CSAT_to_SAT(circuit)
-    write_cnf_file(cnf, outfile)
+    write_cnf_stream(iter_CSAT_clauses(circuit), circuit.n + len(circuit.gates),
+                     count_CSAT_clauses(circuit), outfile)
 
 
 def reduce_CSAT2_to_SAT(infile, outfile):
@@ -252,73 +313,52 @@ def reduce_CSAT2_to_SAT(infile, outfile):
         write_cnf_file([[-1], [1]], outfile)
         return
     composite_circuit = copy_circuit(circuit)
-    cnf = CSAT_to_SAT(composite_circuit)
-    variables_cnf = create_distinct_variables_cnf(
-        composite_circuit.n, composite_circuit.n + len(composite_circuit.gates) + 1)
-    write_cnf_file(cnf + variables_cnf, outfile)
+    first_free_g = composite_circuit.n + len(composite_circuit.gates) + 1
+    pairs = composite_circuit.n // 2
+    # One XOR variable and four clauses per input pair, an OR variable and
+    # three clauses chaining each pair after the first, and the final unit
+    # clause. Without inputs a single variable is asserted both ways.
+    if pairs == 0:
+        n = first_free_g
+        m = count_CSAT_clauses(composite_circuit) + 2
+    else:
+        n = first_free_g + 2 * pairs - 2
+        m = count_CSAT_clauses(composite_circuit) + 7 * pairs - 2
+    clauses = chain(iter_CSAT_clauses(composite_circuit),
+                    create_distinct_variables_cnf(composite_circuit.n, first_free_g))
+    write_cnf_stream(clauses, n, m, outfile)
+
+
+EXAMPLES = [
+    (None, None, 'hole6.cnf', False),
+    (None, None, 'hanoi4.cnf', True),
+    (reduce_CSAT_to_SAT, 'test1.circuit', 'test1.cnf', False),
+    (reduce_CSAT_to_SAT, 'test2.circuit', 'test2.cnf', True),
+    (reduce_CSAT2_to_SAT, 'test2.circuit', 'test2_2.cnf', False),
+    (reduce_CSAT_to_SAT, 'sub1.circuit', 'sub1.cnf', True),
+    (reduce_CSAT_to_SAT, 'sub2.circuit', 'sub2.cnf', True),
+    (reduce_CSAT_to_SAT, 'div1.circuit', 'div1.cnf', True),
+    (reduce_CSAT_to_SAT, 'div2.circuit', 'div2.cnf', False),
+    (reduce_CSAT_to_SAT, 'empty.circuit', 'empty.cnf', False),
+    (reduce_CSAT_to_SAT, 'letter.circuit', 'letter.cnf', False),
+    (reduce_CSAT_to_SAT, 'letters.circuit', 'letters.cnf', False),
+    (reduce_CSAT_to_SAT, 'test3.circuit', 'test3.cnf', False),
+]
 
 
 def run_examples():
-    cnf = read_cnf_file('hole6.cnf')  # UNSAT
-    res = pycosat.solve(cnf)
-    print(res != 'UNSAT')  # False
-
-    cnf = read_cnf_file('hanoi4.cnf')  # SAT
-    res = pycosat.solve(cnf)
-    print(res != 'UNSAT')  # True
-
-    reduce_CSAT_to_SAT('test1.circuit', 'test1.cnf')
-    cnf = read_cnf_file('test1.cnf')
-    res = pycosat.solve(cnf)
-    print(res != 'UNSAT') # False
-
-    reduce_CSAT_to_SAT('test2.circuit', 'test2.cnf')
-    cnf = read_cnf_file('test2.cnf')
-    res = pycosat.solve(cnf)
-    print(res != 'UNSAT') # True
-
-    reduce_CSAT2_to_SAT('test2.circuit', 'test2_2.cnf')
-    cnf = read_cnf_file('test2_2.cnf')
-    res = pycosat.solve(cnf)
-    print(res != 'UNSAT') # True
-
-    reduce_CSAT_to_SAT('sub1.circuit', 'sub1.cnf')
-    cnf = read_cnf_file('sub1.cnf')
-    res = pycosat.solve(cnf)
-    print(res != 'UNSAT') # True
-
-    reduce_CSAT_to_SAT('sub2.circuit', 'sub2.cnf')
-    cnf = read_cnf_file('sub2.cnf')
-    res = pycosat.solve(cnf)
-    print(res != 'UNSAT') # True
-
-    reduce_CSAT_to_SAT('div1.circuit', 'div1.cnf')
-    cnf = read_cnf_file('div1.cnf')
-    res = pycosat.solve(cnf)
-    print(res != 'UNSAT') # True
-
-    reduce_CSAT_to_SAT('div2.circuit', 'div2.cnf')
-    cnf = read_cnf_file('div2.cnf')
-    res = pycosat.solve(cnf)
-    print(res != 'UNSAT') # false
-
-    reduce_CSAT_to_SAT("empty.circuit", "empty.cnf")
-    cnf = read_cnf_file("empty.cnf")
-    res = pycosat.solve(cnf)
-    print(res!='UNSAT') # false
-
-    reduce_CSAT_to_SAT("letter.circuit", "letter.cnf")
-    cnf = read_cnf_file("letter.cnf")
-    res = pycosat.solve(cnf)
-    print(res!='UNSAT') # false
-
-    reduce_CSAT_to_SAT("letters.circuit", "letters.cnf")
-    cnf = read_cnf_file("letters.cnf")
-    res = pycosat.solve(cnf)
-    print(res!='UNSAT') # false
-
-    reduce_CSAT_to_SAT("test3.circuit", "test3.cnf")
-    cnf = read_cnf_file("test3.cnf")
-    res = pycosat.solve(cnf)
-    print(res!='UNSAT') # false
-run_examples()
+    import pycosat
+
+    for reducer, infile, cnf_file, expected in EXAMPLES:
+        if reducer is not None:
+            reducer(infile, cnf_file)
+        cnf = read_cnf_file(cnf_file)
+        res = pycosat.solve(cnf)
+        satisfiable = res != 'UNSAT'
+        print(satisfiable)
+        if satisfiable != expected:
+            print('  {}: expected {}'.format(cnf_file, expected))
+
+
+if __name__ == '__main__':
+    run_examples()